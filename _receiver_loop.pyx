@@ -0,0 +1,229 @@
+# _receiver_loop.pyx is the receiver's main loop for the Reliable Calvin Message Protocol, compiled with Cython
+#
+# Does the same work as the Python loop in Receiver.receive_loop: receive a batch of packets with recvmmsg(2),
+# track which packets have arrived, write each new payload at its own offset with pwrite(2), and ACK the packets
+# that ask for it, all without returning to the interpreter between packets.
+# receiver.py builds and loads it through pyximport when Cython is installed.
+########################################################################################################################
+
+from libc.errno cimport errno, EINTR
+from libc.stdint cimport uint32_t
+from libc.stdlib cimport malloc, calloc, free
+from libc.string cimport memcpy, strerror
+from posix.uio cimport iovec
+from posix.types cimport off_t
+from posix.unistd cimport pwrite
+
+
+cdef extern from "<sys/socket.h>" nogil:
+    ctypedef unsigned int socklen_t
+
+    struct sockaddr:
+        pass
+
+    struct sockaddr_storage:
+        pass
+
+    struct msghdr:
+        void *msg_name
+        socklen_t msg_namelen
+        iovec *msg_iov
+        size_t msg_iovlen
+        void *msg_control
+        size_t msg_controllen
+        int msg_flags
+
+    struct mmsghdr:
+        msghdr msg_hdr
+        unsigned int msg_len
+
+    enum: MSG_WAITFORONE
+
+    int recvmmsg(int sockfd, mmsghdr *msgvec, unsigned int vlen, int flags, void *timeout)
+    ssize_t sendto(int sockfd, const void *buf, size_t len, int flags, const sockaddr *dest_addr, socklen_t addrlen)
+
+
+cdef extern from "<poll.h>" nogil:
+    struct pollfd:
+        int fd
+        short events
+        short revents
+
+    enum: POLLIN
+
+    int poll(pollfd *fds, unsigned long nfds, int timeout)
+
+
+cdef extern from "<arpa/inet.h>" nogil:
+    uint32_t ntohl(uint32_t netlong)
+    uint32_t htonl(uint32_t hostlong)
+
+
+cdef enum:
+    BATCH_SIZE = 64         # packets received per system call
+    HEADER_SIZE = 13        # connection id, file size, packet number, ACK flag
+    ACK_SIZE = 8            # connection id, packet number
+    TIMEOUT_MS = 10000      # how long to wait for the sender once it has started sending
+
+cdef enum:
+    END_OF_DATA = 1
+    SENDER_TIMED_OUT = 0
+    ERROR = -1
+
+
+cdef inline uint32_t read_u32(const char *p) noexcept nogil:
+    """ Read a big-endian unsigned int from the packet """
+    cdef uint32_t value
+    memcpy(&value, p, 4)
+    return ntohl(value)
+
+
+cdef int pwrite_all(int fd, const char *data, size_t size, off_t offset) noexcept nogil:
+    """ pwrite(2) the whole buffer at the given offset, retrying partial writes """
+    cdef ssize_t written
+    while size > 0:
+        written = pwrite(fd, data, size, offset)
+        if written < 0:
+            if errno == EINTR:
+                continue
+            return ERROR
+        data += written
+        size -= written
+        offset += written
+    return 0
+
+
+cdef int receive_loop(int file_fd, int sock_fd, int max_packet_size, char *buf,
+                      mmsghdr *msgs, iovec *iovecs, sockaddr_storage *names,
+                      unsigned char **received, bint simulate_loss) noexcept nogil:
+    cdef int slot_size = HEADER_SIZE + max_packet_size
+    cdef int packet_size = max_packet_size     # payload size of the sender's packets, taken from its packet 0's length
+    cdef uint32_t next_packet_expected = 0   # track the next packet number the receiver is expecting, everything before it has arrived
+    cdef uint32_t packet_count = 0            # packets in the whole file, known once packet 0 arrives
+    cdef uint32_t transfer_id = 0             # the transfer's connection id and file size, from its packet 0
+    cdef uint32_t file_size = 0
+    cdef uint32_t prng_state = 0xDEADBEEF     # linear congruential generator state for dropping ACKs
+    cdef uint32_t connection_id, size, packet_num, ack_num
+    cdef long long data_size
+    cdef int started = 0
+    cdef int count, i, ready
+    cdef char *packet
+    cdef char ack_packet[ACK_SIZE]
+    cdef pollfd pfd
+
+    for i in range(BATCH_SIZE):
+        iovecs[i].iov_base = buf + i * slot_size
+        iovecs[i].iov_len = slot_size
+        msgs[i].msg_hdr.msg_name = &names[i]
+        msgs[i].msg_hdr.msg_iov = &iovecs[i]
+        msgs[i].msg_hdr.msg_iovlen = 1
+        msgs[i].msg_hdr.msg_control = NULL
+        msgs[i].msg_hdr.msg_controllen = 0
+        msgs[i].msg_hdr.msg_flags = 0
+
+    pfd.fd = sock_fd
+    pfd.events = POLLIN
+
+    # Main loop
+    while True:
+        # only time out once the sender has started, so the receiver can be started first
+        if started:
+            ready = poll(&pfd, 1, TIMEOUT_MS)
+            if ready == 0:
+                return SENDER_TIMED_OUT
+            if ready < 0:
+                if errno == EINTR:
+                    continue
+                return ERROR
+
+        for i in range(BATCH_SIZE):
+            msgs[i].msg_hdr.msg_namelen = sizeof(sockaddr_storage)
+        count = recvmmsg(sock_fd, msgs, BATCH_SIZE, MSG_WAITFORONE, NULL)
+        if count < 0:
+            if errno == EINTR:
+                continue
+            return ERROR
+        started = 1
+
+        for i in range(count):
+            if msgs[i].msg_len <= HEADER_SIZE:     # not an RCMP data packet
+                continue
+            packet = buf + i * slot_size
+            connection_id = read_u32(packet)
+            size = read_u32(packet + 4)
+            packet_num = read_u32(packet + 8)
+
+            if received[0] == NULL:
+                # the sender always starts with packet 0, and keeps retransmitting from it until it's ACK'd,
+                # so the transfer is taken from the first packet 0 to arrive and anything before it is skipped
+                if packet_num != 0 or size == 0:
+                    continue
+                transfer_id = connection_id
+                file_size = size
+                packet_size = <int> msgs[i].msg_len - HEADER_SIZE
+                packet_count = (file_size + packet_size - 1) // packet_size
+                received[0] = <unsigned char *> calloc(packet_count // 8 + 1, 1)     # one bit per packet of the file
+                if received[0] == NULL:
+                    return ERROR
+            elif (connection_id != transfer_id or size != file_size
+                  or <int> msgs[i].msg_len - HEADER_SIZE != packet_size or packet_num >= packet_count):
+                continue        # left over from another transfer, or not an RCMP data packet
+
+            # duplicates are ignored, every new packet is written at its own offset whatever order it arrives in
+            if not received[0][packet_num >> 3] & (1 << (packet_num & 7)):
+                received[0][packet_num >> 3] |= 1 << (packet_num & 7)
+                data_size = file_size - <long long> packet_size * packet_num
+                if data_size > packet_size:     # only the final packet is cut short, to drop the filler
+                    data_size = packet_size
+                if pwrite_all(file_fd, packet + HEADER_SIZE, data_size, <off_t> packet_size * packet_num) < 0:
+                    return ERROR
+                while (next_packet_expected < packet_count
+                       and received[0][next_packet_expected >> 3] & (1 << (next_packet_expected & 7))):
+                    next_packet_expected += 1
+
+            # always ACK the final packet, whichever packet completed the file, otherwise ACK flagged packets;
+            # if a packet before it is missing, repeat the ACK for everything that has arrived in order,
+            # which tells the sender to retransmit without waiting for its ACK timeout
+            if next_packet_expected == packet_count or (packet[12] and next_packet_expected > 0):
+                if next_packet_expected == packet_count:
+                    packet_num = packet_count - 1
+                elif packet_num >= next_packet_expected:
+                    packet_num = next_packet_expected - 1
+                ack_num = htonl(packet_num)
+                memcpy(ack_packet, packet, 4)           # connection id, already in network order
+                memcpy(ack_packet + 4, &ack_num, 4)
+                # with SIMULATE_LOSS, don't send some of the ACKs, same generator as receiver.py
+                if simulate_loss:
+                    prng_state = prng_state * 1103515245u + 12345u
+                if not simulate_loss or (prng_state >> 28) < 13:
+                    sendto(sock_fd, ack_packet, ACK_SIZE, 0,
+                           <sockaddr *> &names[i], msgs[i].msg_hdr.msg_namelen)
+
+            if next_packet_expected == packet_count:
+                return END_OF_DATA
+
+
+def run(int file_fd, int sock_fd, int max_packet_size, bint simulate_loss=False):
+    """
+    Receive the file from the socket into file_fd, in packets of up to max_packet_size bytes of payload
+    Return True once the final packet has been written, False if the sender stopped sending
+    simulate_loss drops ~20% of the ACKs, as receiver.py's SIMULATE_LOSS does
+    """
+    cdef char *buf = <char *> malloc((HEADER_SIZE + max_packet_size) * BATCH_SIZE)
+    cdef mmsghdr msgs[BATCH_SIZE]
+    cdef iovec iovecs[BATCH_SIZE]
+    cdef sockaddr_storage names[BATCH_SIZE]
+    cdef unsigned char *received = NULL
+    cdef int result
+    if buf == NULL:
+        raise MemoryError()
+
+    try:
+        with nogil:
+            result = receive_loop(file_fd, sock_fd, max_packet_size, buf, msgs, iovecs, names, &received, simulate_loss)
+        if result == ERROR:
+            raise OSError(errno, strerror(errno).decode())
+        return result == END_OF_DATA
+    finally:
+        free(buf)
+        free(received)
@@ -0,0 +1,211 @@
+# mmsg.py batches datagrams for the Reliable Calvin Message Protocol
+#
+# Wraps the Linux recvmmsg(2)/sendmmsg(2) system calls with ctypes so the sender and receiver
+# can move a whole batch of packets per system call instead of one.
+# On platforms without them, the batches fall back to one recvfrom_into/sendto per packet.
+########################################################################################################################
+
+from socket import AF_INET, IPPROTO_UDP, inet_aton, inet_ntoa, timeout
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+BATCH_SIZE = 64             # number of packets moved per system call
+SOCKADDR_IN_SIZE = 16       # sizeof(struct sockaddr_in)
+MSG_WAITFORONE = 0x10000    # block for the first datagram only, then take whatever else is queued
+UDP_SEGMENT = 103           # linux/udp.h, generic segmentation offload for UDP
+UDP_MAX_SEGMENTS = 64       # most datagrams the kernel will cut one send into
+UDP_MAX_PAYLOAD = 65507     # largest UDP payload over IPv4, bounds the size of one segmented send
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", msghdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_recvmmsg = getattr(_libc, "recvmmsg", None)
+_sendmmsg = getattr(_libc, "sendmmsg", None)
+
+if _recvmmsg is not None:
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+if _sendmmsg is not None:
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+
+
+def _raise_errno():
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+
+class _Batch:
+    """
+    A fixed number of equally sized packet slots in one flat buffer,
+    with an iovec/mmsghdr pair pointing at each slot
+    """
+    def __init__(self, sock, slot_size, count):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.slot_size = slot_size
+        self.count = count
+        self.buf = bytearray(slot_size * count)
+        self.view = memoryview(self.buf)
+        self.slots = [self.view[i * slot_size:(i + 1) * slot_size] for i in range(count)]
+
+        self._base = ctypes.c_char.from_buffer(self.buf)   # keeps the buffer pinned while the iovecs point into it
+        base_addr = ctypes.addressof(self._base)
+        self._iovecs = (iovec * count)()
+        self._msgs = (mmsghdr * count)()
+        for i in range(count):
+            self._iovecs[i].iov_base = base_addr + i * slot_size
+            self._iovecs[i].iov_len = slot_size
+            self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            self._msgs[i].msg_hdr.msg_iovlen = 1
+
+
+class RecvBatch(_Batch):
+    """ Receive up to count packets per system call """
+    def __init__(self, sock, slot_size, count=BATCH_SIZE):
+        super().__init__(sock, slot_size, count)
+        self._names = (ctypes.c_char * SOCKADDR_IN_SIZE * count)()    # source address of each received packet
+        self._fallback_addr = None
+        self._fallback_length = 0
+        for i in range(count):
+            self._msgs[i].msg_hdr.msg_name = ctypes.addressof(self._names[i])
+            self._msgs[i].msg_hdr.msg_namelen = SOCKADDR_IN_SIZE
+
+    def recv(self):
+        """
+        Wait for at least one packet, honouring the socket's timeout, then take as many as are already queued
+        Return the number of packets received, they fill slots 0..n-1
+        """
+        if _recvmmsg is None:
+            self._fallback_length, self._fallback_addr = self.sock.recvfrom_into(self.slots[0])
+            return 1
+
+        while True:
+            received = _recvmmsg(self.fd, self._msgs, self.count, MSG_WAITFORONE, None)
+            if received >= 0:
+                return received
+
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                _raise_errno()
+
+            # a socket with a timeout is non-blocking underneath, so wait for it to become readable ourselves
+            if not select.select([self.sock], [], [], self.sock.gettimeout())[0]:
+                raise timeout("timed out")
+
+    def length(self, slot):
+        """ Size of the packet received into the given slot """
+        if _recvmmsg is None:
+            return self._fallback_length
+        return self._msgs[slot].msg_len
+
+    def address(self, slot):
+        """ (host, port) the packet in the given slot was sent from """
+        if _recvmmsg is None:
+            return self._fallback_addr
+        raw = self._names[slot].raw
+        return inet_ntoa(raw[4:8]), int.from_bytes(raw[2:4], "big")
+
+
+class SendBatch(_Batch):
+    """ Packets kept in slots, any run of which can be sent to one address with as few system calls as possible """
+    def __init__(self, sock, slot_size, addr, count=BATCH_SIZE):
+        super().__init__(sock, slot_size, count)
+        self.addr = addr
+        self.gso_segments = 0   # slots per segmented send, 0 while segmentation offload is off
+
+        # every packet goes to the same address, so all messages share one sockaddr_in
+        self._name = ctypes.create_string_buffer(
+            struct.pack("=H", AF_INET) + addr[1].to_bytes(2, "big") + inet_aton(addr[0]), SOCKADDR_IN_SIZE)
+        for i in range(count):
+            self._msgs[i].msg_hdr.msg_name = ctypes.addressof(self._name)
+            self._msgs[i].msg_hdr.msg_namelen = SOCKADDR_IN_SIZE
+
+    def enable_gso(self):
+        """
+        Turn on UDP generic segmentation offload: the slots are contiguous and equally sized,
+        so a run of them can be sent as one buffer that the kernel (or NIC) splits back into packets
+        Return whether the kernel supports it
+        """
+        try:
+            self.sock.setsockopt(IPPROTO_UDP, UDP_SEGMENT, self.slot_size)
+        except OSError:
+            return False
+        self.gso_segments = min(UDP_MAX_SEGMENTS, UDP_MAX_PAYLOAD // self.slot_size, self.count)
+        return self.gso_segments > 1
+
+    def send(self, first, end):
+        """ Send slots first..end-1, in order """
+        sent = first
+        while sent < end and self.gso_segments > 1:
+            stop = min(sent + self.gso_segments, end)
+            try:
+                self.sock.sendto(self.view[sent * self.slot_size:stop * self.slot_size], self.addr)
+            except BlockingIOError:
+                self._wait_writable()
+                continue
+            except OSError:
+                # the route's device can't segment, or its path MTU has dropped below a packet and they need
+                # fragmenting: turn it off and send the rest one packet per message
+                self.sock.setsockopt(IPPROTO_UDP, UDP_SEGMENT, 0)
+                self.gso_segments = 0
+                break
+            sent = stop
+
+        while sent < end:
+            if _sendmmsg is None:
+                try:
+                    self.sock.sendto(self.slots[sent], self.addr)
+                except BlockingIOError:
+                    self._wait_writable()
+                    continue
+                sent += 1
+                continue
+
+            result = _sendmmsg(self.fd, ctypes.byref(self._msgs[sent]), end - sent, 0)
+            if result >= 0:
+                sent += result
+                continue
+
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._wait_writable()
+                continue
+            _raise_errno()
+
+    def _wait_writable(self):
+        """ The socket is non-blocking (or has a timeout), wait for the kernel to make room in the send buffer """
+        select.select([], [self.sock], [], self.sock.gettimeout() or None)
@@ -11,20 +11,63 @@
 ########################################################################################################################
 
 from socket import *
+import socket as socket_module
+import fcntl
+import ipaddress
+import os
 import sys
-from icecream import ic
+from mmsg import RecvBatch
 import struct
-import random
 
-PACKET_SIZE = 2048
+try:    # the main loop compiled with Cython, used instead of the Python loop whenever it can be built
+    import pyximport
+    pyximport.install(language_level=3)
+    import _receiver_loop
+except ImportError:
+    _receiver_loop = None
 
-# TO TOGGLE DEBUGGING, UNCOMMENT/COMMENT THE NEXT LINE
-# ic.disable()
+PACKET_SIZE = 8959     # largest payload, the sender may use smaller packets to fit the path MTU
 
+# precompiled packet formats, so the format string isn't re-parsed on every packet
+_HDR = struct.Struct("!3I?")          # connection id, file size, packet number, ACK flag
+_ACK = struct.Struct("!2I")           # connection id, packet number
+HEADER_SIZE = _HDR.size
+
+SOCKET_BUFFER_SIZE = 12 * 1024 * 1024   # kernel socket buffer, big enough to absorb a full burst of packets
+SO_INCOMING_CPU = getattr(socket_module, "SO_INCOMING_CPU", 49)   # exposed by the socket module from Python 3.11
+SIOCGIFADDR = 0x8915    # linux/sockios.h, an interface's IPv4 address
+
+# drop ~20% of the ACKs to simulate packet loss while testing retransmission, never wanted for a real transfer
+SIMULATE_LOSS = False
+
+# run the receiver on the CPU that handles the sender's packets as they come off the network card,
+# worth turning on for a dedicated receiver host, it takes that CPU for the whole transfer
+PIN_TO_NIC_CPU = False
+
+# TO TOGGLE DEBUGGING, SET DEBUG TO True (requires icecream)
+# every ic() call is guarded by it, so none of the debugging output costs anything when it's off
+DEBUG = False
+if DEBUG:
+    from icecream import ic
+
+
+def next_missing_packet(received, packet_num):
+    """
+    First packet number from packet_num on that hasn't arrived yet
+    The received bits are scanned 64 packets at a time, counting the run of set bits from packet_num
+    """
+    while True:
+        byte, shift = packet_num >> 3, packet_num & 7
+        chunk = received[byte:byte + 8]
+        if not chunk:
+            return packet_num
+        bits = int.from_bytes(chunk, "little") >> shift     # bit 0 is packet_num
+        arrived = (~bits & (bits + 1)).bit_length() - 1     # trailing set bits, packets that arrived in a row
+        available = len(chunk) * 8 - shift
+        packet_num += arrived
+        if arrived < available:
+            return packet_num
 
-class EndOfData(Exception):
-    """ Raised when the receiver reaches the end of expected file data """
-    pass
 
 class Receiver:
     """
@@ -34,88 +77,208 @@ class Receiver:
     def __init__(self, port, filename):
         self.port = port
         self.filename = filename
-        self.next_packet_expected = 0   # track the next packet number the receiver is expecting
 
     def start(self):
         """ establish UDP socket for receiver, open file for reading, begin execution """
         receiver_addr = ("", self.port)
         self.receiver_socket = socket(AF_INET, SOCK_DGRAM)
         self.receiver_socket.bind(receiver_addr)
-        ic("Receiver bound to localhost")
+        self.receiver_socket.setsockopt(SOL_SOCKET, SO_RCVBUF, SOCKET_BUFFER_SIZE)    # capped by net.core.rmem_max
+        if DEBUG:
+            ic(self.receiver_socket.getsockopt(SOL_SOCKET, SO_RCVBUF))
+            ic("Receiver bound to localhost")
+        if PIN_TO_NIC_CPU:
+            self.pin_to_nic_cpu()
+
+        # packets are received a batch at a time, each payload is a view into the batch rather than a copy
+        self._rx = RecvBatch(self.receiver_socket, HEADER_SIZE + PACKET_SIZE)
+        self._payloads = [slot[HEADER_SIZE:] for slot in self._rx.slots]
 
         try:
             with open(self.filename, 'wb') as self.file:
-                ic("File opened for reading")
+                self.fd = self.file.fileno()    # packets are written at their own offset, so they can arrive in any order
+                if DEBUG:
+                    ic("File opened for reading")
 
-                # Main loop
-                while True:
-                    try:
-                        self.receive_packet()
-                        if self.packet_num < self.next_packet_expected:     # duplicate packet received
-                            ic("Received duplicate packet")
-                        elif self.packet_num == self.next_packet_expected:  # packet received has next expected packet num
-                            ic("Received the next expected packet")         # NOTE: future packets are dropped
-                            self.next_packet_expected += 1      # update the next expected packet
-                            self.write_packet()
-                        if self.is_acked:
-                            self.send_ack()
-                    except EndOfData:
+                # compiled main loop, the Python loop in receive_loop is kept for debugging output
+                if _receiver_loop is not None and not DEBUG:
+                    if _receiver_loop.run(self.fd, self.receiver_socket.fileno(), PACKET_SIZE, SIMULATE_LOSS):
                         print("reached end of expected data")
-                        break
-                    except timeout:
+                    else:
                         print("No messages from sender, closing connection")
-                        break
+                    return
+
+                # Main loop
+                try:
+                    if self.receive_loop():
+                        print("reached end of expected data")
+                except timeout:
+                    print("No messages from sender, closing connection")
         finally:
             self.receiver_socket.close()
 
 
-    def receive_packet(self):
-        """ Receive a packet from the socket, unpack all data from the packet """
-        raw_data, self.sender_addr = self.receiver_socket.recvfrom(PACKET_SIZE + 13)         # receive data from sender
-        self.receiver_socket.settimeout(10)     # set timeout after 1st packet received so receiver doesn't timeout
-        ic("Received a packet")                 # before sender is started
+    def pin_to_nic_cpu(self):
+        """
+        Wait for the sender's first packet, then run the receiver on the CPU that handled it and hint the socket to it,
+        so the rest of the transfer is handled where its packets arrive
+        The kernel records that CPU on the socket: the one servicing the receive queue the network card steers this
+        flow to. If it can't say, fall back to the receive interrupts of the interface the packet came in on
+        Does nothing for a sender on this host, whose packets never touch the network card, or if the OS can't pin processes
+        """
+        try:
+            sender_host = self.receiver_socket.recvfrom(1, MSG_PEEK)[1][0]    # leaves the packet queued for the main loop
 
-        # deconstruct raw data into a quin-tuple
-        (
-            self.connection_id,
-            self.expected_file_size,
-            self.packet_num,
-            self.is_acked,
-            self.payload,
-        ) = struct.unpack("!3I?2048s", raw_data)
+            # the local address the receiver answers the sender from picks out the interface the flow uses
+            probe = socket(AF_INET, SOCK_DGRAM)
+            try:
+                probe.connect((sender_host, self.port))
+                local_host = probe.getsockname()[0]
+            finally:
+                probe.close()
+            if ipaddress.ip_address(sender_host).is_loopback or sender_host == local_host:
+                return
 
-        ic(self.packet_num, self.next_packet_expected)
+            cpu = self.receiver_socket.getsockopt(SOL_SOCKET, SO_INCOMING_CPU)
+            if cpu < 0:
+                cpu = self.interface_rx_cpu(local_host)
+            if cpu is None:
+                return
 
-    def write_packet(self):
-        """
-        Handle the case where packet is the final packet*
-        Write the received data to the output file
+            os.sched_setaffinity(0, {cpu})
+            self.receiver_socket.setsockopt(SOL_SOCKET, SO_INCOMING_CPU, cpu)
+        except (AttributeError, OSError, ValueError):    # not Linux, or /proc isn't readable
+            return
 
-        *Because each struct packet is always the same size, I detect the final packet in a more creative
-        way than is outlined in the protocol description
+        if DEBUG:
+            ic("Receiver pinned to CPU", cpu)
+
+    def interface_rx_cpu(self, local_host):
+        """
+        Find the interface with the given address, then a CPU that services its receive interrupts
+        (from /proc/interrupts and /proc/irq), or None if there is no such CPU to be found
         """
-        if (PACKET_SIZE * (self.packet_num + 1)) > self.expected_file_size:           # if amount of data received is larger than expected, handle final packet
-            remaining_data_size = -1 * ((PACKET_SIZE * self.packet_num) - self.expected_file_size)   # calculate amount of valuable data in final packet
-            remaining_data = self.payload[0:remaining_data_size]                 # slice payload to get relevant data
+        probe = socket(AF_INET, SOCK_DGRAM)
+        try:
+            for _, interface in if_nameindex():
+                request = struct.pack("256s", interface.encode()[:15])
+                try:
+                    address = inet_ntoa(fcntl.ioctl(probe.fileno(), SIOCGIFADDR, request)[20:24])
+                except OSError:     # no IPv4 address
+                    continue
+                if address == local_host:
+                    break
+            else:
+                return None
+        finally:
+            probe.close()
 
-            ic("writing final packet")
-            self.file.write(remaining_data)                     # write data from final packet, not including filler
-            raise EndOfData
+        # interrupts are named after the interface, or after its device for drivers like virtio, then the queue
+        names = [interface]
+        device = os.path.join("/sys/class/net", interface, "device")
+        if os.path.exists(device):
+            names.append(os.path.basename(os.path.realpath(device)))
 
-        ic("writing payload to file")
-        self.file.write(self.payload)            # if we haven't exited yet, write entire payload to file
+        with open("/proc/interrupts") as interrupts:
+            for line in interrupts:
+                fields = line.split()
+                irq = fields[0].rstrip(":") if fields else ""
+                action = fields[-1].lower() if fields else ""
+                named = any(action == name or action.startswith(name + "-") for name in names)
+                if irq.isdigit() and named and ("rx" in action or "input" in action):
+                    with open(f"/proc/irq/{irq}/smp_affinity_list") as affinity:
+                        return int(affinity.read().split(",")[0].split("-")[0])
+        return None
 
-    def send_ack(self):
+    def receive_loop(self):
         """
-        Build and send an ACK packet according to RCMP specifications
-        https://docs.google.com/document/d/19--3X5IwwDtJxeIE13WgtKm-gswR6fF8bejL468gIpo/edit#heading=h.r7wm0ewuayds
+        Receive batches of packets, write every new one at its own offset, ACK the ones that ask for it
+        Everything the loop needs is bound to a local up front: its body runs for every packet, and touches only locals
+        Return True once every packet of the file has arrived, a socket timeout means the sender stopped sending
         """
-        ack_packet = struct.pack("!2I", self.connection_id, self.packet_num)
-                
-        ic(self.is_acked, "sending ack packet")
-        if random.randint(1, 10) <= 8:    # don't send some of the ACKs to simulate packet loss
-            self.receiver_socket.sendto(ack_packet, self.sender_addr)
+        sock = self.receiver_socket
+        rx = self._rx
+        recv, length, address = rx.recv, rx.length, rx.address
+        buf, slot_size = rx.buf, rx.slot_size
+        payloads = self._payloads
+        unpack = _HDR.unpack_from
+        pack_ack = _ACK.pack
+        sendto = sock.sendto
+        pwrite = os.pwrite
+        fd = self.fd
+        debug = DEBUG
+        simulate_loss = SIMULATE_LOSS
+
+        next_exp = 0            # track the next packet number the receiver is expecting, everything before it has arrived
+        transfer_id = file_size = packet_size = 0   # the transfer's connection id, file size and payload size, from its packet 0
+        packet_count = 0        # packets in the whole file, known once packet 0 arrives
+        received = None         # one bit per packet of the file, set once the packet has arrived
+        prng_state = 0xDEADBEEF     # linear congruential generator state for dropping ACKs, when SIMULATE_LOSS is on
+
+        count = recv()          # receive data from sender
+        sock.settimeout(10)     # set timeout after 1st packet received so receiver doesn't timeout before sender is started
+        while True:
+            if debug:
+                ic("Received a batch of packets", count)
+            for slot in range(count):
+                payload_size = length(slot) - HEADER_SIZE
+                if payload_size <= 0:       # not an RCMP data packet
+                    continue
+                # deconstruct the header into a quad-tuple, the payload stays in the receive buffer
+                connection_id, size, packet_num, is_acked = unpack(buf, slot * slot_size)
+                if received is None:
+                    # the sender always starts with packet 0, and keeps retransmitting from it until it's ACK'd,
+                    # so the transfer is taken from the first packet 0 to arrive and anything before it is skipped
+                    if packet_num or not size:
+                        continue
+                    transfer_id, file_size, packet_size = connection_id, size, payload_size
+                    packet_count = (file_size + packet_size - 1) // packet_size
+                    received = bytearray(packet_count // 8 + 1)
+                elif (connection_id != transfer_id or size != file_size or payload_size != packet_size
+                        or packet_num >= packet_count):
+                    continue                # left over from another transfer, or not an RCMP data packet
+                if debug:
+                    ic(packet_num, next_exp)
+
+                byte, bit = packet_num >> 3, 1 << (packet_num & 7)
+                if received[byte] & bit:        # duplicate packet received
+                    if debug:
+                        ic("Received duplicate packet")
+                else:                           # new packet, in order or not
+                    # write at the packet's own offset, the final packet without its filler
+                    offset = packet_size * packet_num
+                    pwrite(fd, payloads[slot][:min(packet_size, file_size - offset)], offset)
+                    received[byte] |= bit
+                    if packet_num == next_exp:
+                        next_exp += 1
+                        if received[next_exp >> 3] & (1 << (next_exp & 7)):    # packets that arrived early follow it
+                            next_exp = next_missing_packet(received, next_exp)
+                    if debug:
+                        ic("Received a new packet, written to file")
+
+                if next_exp == packet_count:
+                    packet_num = packet_count - 1   # always ACK the final packet, whichever packet completed the file
+                elif not is_acked or not next_exp:
+                    continue
+                elif packet_num >= next_exp:
+                    # a packet before this one is missing: repeat the ACK for everything that has arrived in order,
+                    # which tells the sender to retransmit without waiting for its ACK timeout
+                    packet_num = next_exp - 1
+
+                # build the ACK according to RCMP specifications
+                if debug:
+                    ic(is_acked, "sending ack packet")
+                if simulate_loss:
+                    # don't send some of the ACKs: step a cheap LCG and keep 13 in 16 (~80%) of them
+                    prng_state = (prng_state * 1103515245 + 12345) & 0xFFFFFFFF
+                    if (prng_state >> 28) < 13:
+                        sendto(pack_ack(connection_id, packet_num), address(slot))
+                else:
+                    sendto(pack_ack(connection_id, packet_num), address(slot))
+                if next_exp == packet_count:
+                    return True
 
+            count = recv()
 
 # Take in commandline arguments
 portnum = sys.argv[1]
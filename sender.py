@@ -12,25 +12,41 @@
 ########################################################################################################################
 
 from socket import *
-from icecream import ic
+from mmsg import BATCH_SIZE, SendBatch
 import random
 import os
+import selectors
 import sys
 import struct
+import time
 
-PACKET_SIZE = 2048
+PACKET_SIZE = 8959     # largest payload, sized so a whole packet fills a 9000-byte jumbo frame
+IP_UDP_HEADER_SIZE = 28     # IPv4 + UDP headers in front of every packet
 
-# TO TOGGLE DEBUGGING, UNCOMMENT/COMMENT THE NEXT LINE
-# ic.disable()
+IP_MTU = 14     # linux/in.h, not exposed by the socket module
 
+# precompiled packet formats, so the format string isn't re-parsed on every packet
+_HDR = struct.Struct("!3I?")          # connection id, file size, packet number, ACK flag
+_ACK = struct.Struct("!2I")           # connection id, packet number
+HEADER_SIZE = _HDR.size
+ACK_FLAG_OFFSET = HEADER_SIZE - 1
 
-class NoData(Exception):
-    """ Raised if sender tries to read data when there is none to be read """
-    pass
+SOCKET_BUFFER_SIZE = 12 * 1024 * 1024   # kernel socket buffer, big enough to absorb a full burst of packets
+READ_BUFFER_SIZE = 1024 * 1024          # file read-ahead, so the file is read in large chunks rather than one packet at a time
+
+ACK_TIMEOUT = 1         # most seconds to wait for an ACK before retransmitting, and the wait until the round trip is measured
+MIN_ACK_TIMEOUT = 0.05  # least seconds to wait for an ACK, however short the round trip
+RECEIVER_TIMEOUT = 5 * ACK_TIMEOUT  # seconds without any ACK before giving up on the receiver
+
+# TO TOGGLE DEBUGGING, SET DEBUG TO True (requires icecream)
+# every ic() call is guarded by it, so none of the debugging output costs anything when it's off
+DEBUG = False
+if DEBUG:
+    from icecream import ic
 
 
 class ReceiverNotResponding(Exception):
-    """ Raised if 5 consecutive ACKs are not received """
+    """ Raised if no ACKs are received for RECEIVER_TIMEOUT seconds """
     pass
 
 
@@ -50,123 +66,253 @@ class Sender:
         self.is_acked = False                        # ACK flag, 0 = Don't ACK, 1 = ACK
         self.ack_gap = 0                             # ACK gap counter, incremented for each received ACK
         self.last_acked_packet_num = 0               # variable to track last ACK'd packet number
+        self.last_flagged_packet_num = 0             # packet number of the last packet sent with the ACK flag
         self.timeout_counter = 0                     # track the amount of times consecutive timeouts occur
+        self.last_ack_at = 0                         # time the last ACK arrived
+        self.rtt = None                              # smoothed round trip time from sending a flagged packet to its ACK
+        self.ack_timeout = ACK_TIMEOUT               # wait for an ACK before retransmitting, 4 round trips once measured
+        self.first_unacked = 0                       # every packet before this one has been ACK'd
+        self.outstanding = {}                        # packet number: send time, for every ACK flagged packet not yet ACK'd
+        self.recovery_point = -1                     # last packet sent before the last rewind, repeated ACKs are ignored until it's ACK'd
 
-        ic(self.connection_id)
-        ic(filename, self.file_size)
+        if DEBUG:
+            ic(self.connection_id)
+            ic(filename, self.file_size)
 
     def start(self):
         """ Initialize a UDP socket and open the file, begin execution """
-        self.receiver_addr = (self.server, self.port)
+        self.receiver_addr = (gethostbyname(self.server), self.port)
         self.sender_socket = socket(AF_INET, SOCK_DGRAM)
-        self.sender_socket.settimeout(1)
+        self.sender_socket.setblocking(False)   # sending never waits on ACKs, they're picked up as they arrive
+        self.sender_socket.setsockopt(SOL_SOCKET, SO_SNDBUF, SOCKET_BUFFER_SIZE)    # capped by net.core.wmem_max
+        if DEBUG:
+            ic(self.sender_socket.getsockopt(SOL_SOCKET, SO_SNDBUF))
+
+        self.packet_size = self.path_packet_size()                          # payload size of every packet
+        self.final_packet_index = (self.file_size - 1) // self.packet_size  # packet number of the last packet
+        self.packet_count = self.final_packet_index + 1
+        # most packets in flight without an ACK: as many as the socket buffer the kernel granted holds (it reports double,
+        # for its bookkeeping). The receiver asks for the same size, a receiver that got less halves the window on loss
+        buffer_size = self.sender_socket.getsockopt(SOL_SOCKET, SO_SNDBUF) // 2
+        self.max_window = max(1, buffer_size // (HEADER_SIZE + self.packet_size))
+        self.window = self.max_window   # packets allowed in flight, halved on packet loss and grown back as ACKs arrive
+        self.window_acked = 0           # packets ACK'd since the window last grew
+        if DEBUG:
+            ic(self.packet_size, self.packet_count, self.max_window)
+
+        # every packet of the file gets its own slot: it's built once, then sent and retransmitted straight from there
+        self._packets = SendBatch(self.sender_socket, HEADER_SIZE + self.packet_size, self.receiver_addr,
+                                  max(self.packet_count, 1))    # an empty file still needs a (never sent) slot
+        gso_enabled = self._packets.enable_gso()
+        if DEBUG:
+            ic(gso_enabled)
+
+        # only readability is watched: a UDP socket is almost always writable, and a full send buffer is waited out in flush
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sender_socket, selectors.EVENT_READ)
 
         # open specified file for reading
         try:
-            with open(self.filename, 'rb') as self.file:
+            with open(self.filename, 'rb', buffering=READ_BUFFER_SIZE) as self.file:
                 print("File", self.filename, "opened for reading")
+                self.build_packets()
+                self.last_ack_at = time.monotonic()
 
-                # Main loop
-                while True:
+                # Main loop, runs until every packet of the file has been ACK'd
+                while self.first_unacked < self.packet_count:
                     try:
-                        self.read_packet()
-                        self.set_is_acked()
-                        packet = self.build_packet()
-                        self.send_packet(packet)
-                        if self.is_acked:
-                            self.await_ack()
-                    except NoData:
-                        break
+                        self.send_window()
+
+                        # only sleep when the window is full, and then only until the oldest ACK is due
+                        if self.selector.select(0 if self.can_send() else self.time_until_timeout()):
+                            self.receive_acks()
+                        self.check_timeouts()
                     except ReceiverNotResponding:
-                        print("ReceiverNotResponding: 5 consecutive ACKs not received, exiting")
+                        print("ReceiverNotResponding: no ACKs received for", RECEIVER_TIMEOUT, "seconds, exiting")
                         print("File transfer success unknown")
                         break
         finally:
+            self.selector.close()
             self.sender_socket.close()
 
+    def path_packet_size(self):
+        """
+        Size packets to fit the route's MTU to the receiver, up to PACKET_SIZE
+        A lost fragment loses the whole packet, so a route without jumbo frames gets smaller packets instead
+        The kernel only knows the MTU of the route so far, so fragmentation is left on: every packet is built
+            before sending starts, and a smaller MTU further along the path fragments them rather than failing the send
+        The receiver works out the packet size from the length of the packets it receives
+        """
+        try:
+            # the kernel only reports the path MTU for a connected socket, so ask through a throwaway one
+            probe = socket(AF_INET, SOCK_DGRAM)
+            try:
+                probe.connect(self.receiver_addr)
+                mtu = probe.getsockopt(IPPROTO_IP, IP_MTU)
+            finally:
+                probe.close()
+        except OSError:     # not Linux, leave it all to fragmentation
+            return PACKET_SIZE
+
+        return min(PACKET_SIZE, mtu - IP_UDP_HEADER_SIZE - HEADER_SIZE)
+
+    def build_packets(self):
+        """ Read the whole file into packets up front, so sending and retransmitting never touch the file """
+        for self.packet_index in range(self.packet_count):
+            self.read_packet()
+            self.build_packet()
+        self.packet_index = 0
+
+    def can_send(self):
+        """ Whether there is more of the file to send and room in the window for it """
+        return self.packet_index < self.packet_count and self.packet_index - self.first_unacked < self.window
+
+    def send_window(self):
+        """ Flag and send new packets until the window is full or a batch's worth has gone out """
+        first = self.packet_index
+        while self.can_send() and self.packet_index - first < BATCH_SIZE:
+            self.set_is_acked()
+            self.send_packet()
+        self.flush_packets(first, self.packet_index)
+
     def read_packet(self):
-        """ Read a packet from the file """
-        self.data = self.file.read(PACKET_SIZE)  # read data from the file
-        if not self.data:            # if there is no more data, don't try to send, break
-            raise NoData
+        """ Read a packet from the file into its slot """
+        self._packet = self._packets.slots[self.packet_index]
+        payload = self._packet[HEADER_SIZE:]
+        self.file.readinto(payload)     # read data from the file into the packet buffer, a short final packet stays zero-filled
 
     def set_is_acked(self):
         """
         Determine whether a packet should be ACK'd or not, set the ACK flag accordingly
-        if the amount of packets sent since the last ACK'd packet is the same as the ack_gap, ack the next packet
+        if the amount of packets sent since the last ACK flagged packet has reached the ack_gap, ack the next packet
+        the final packet is always ACK'd, so the sender knows the whole file arrived
         """
-        if self.packet_index - self.last_acked_packet_num == self.ack_gap:
+        if (self.packet_index - self.last_flagged_packet_num >= self.ack_gap
+                or self.packet_index == self.final_packet_index):
             self.is_acked = 1
+            self.last_flagged_packet_num = self.packet_index
         else:
             self.is_acked = 0
 
     def build_packet(self):
         """
-        Build a packet according to RCMP specifications
+        Build a packet according to RCMP specifications, the ACK flag is set when it's sent
         https://docs.google.com/document/d/19--3X5IwwDtJxeIE13WgtKm-gswR6fF8bejL468gIpo/edit#heading=h.r7wm0ewuayds
         """
-        return struct.pack("!3I?2048s",
-                            self.connection_id,
-                            self.file_size,
-                            self.packet_index,
-                            self.is_acked,
-                            self.data)
-
-    def send_packet(self, packet):
-        """ Send a packet over the socket, increment packet number, wait for an ACK if necessary """
-        try:
-            self.sender_socket.sendto(packet, self.receiver_addr)
-            self.packet_index += 1
+        _HDR.pack_into(self._packet, 0,
+                       self.connection_id,
+                       self.file_size,
+                       self.packet_index,
+                       False)
+
+    def send_packet(self):
+        """ Set the packet's ACK flag, start its ACK timer if it's flagged, increment packet number """
+        if self.is_acked:
+            self._packets.slots[self.packet_index][ACK_FLAG_OFFSET] = 1
+            self.outstanding[self.packet_index] = time.monotonic()
+        self.packet_index += 1
+        if DEBUG:
             ic(self.is_acked)
+
+    def flush_packets(self, first, end):
+        """ Send packets first..end-1 over the socket, many per system call """
+        try:
+            self._packets.send(first, end)
         except Exception:
             print("Error while transmitting a packet")
 
-    def await_ack(self):
+    def receive_acks(self):
         """
-        Wait to receive ACK packet from the receiver, unpack the ACK
-        Increment the gap between ACKs, reset the consecutive timeout counter,
+        Unpack every ACK packet waiting on the socket
+        For each, increment the gap between ACKs, reset the consecutive timeout counter,
             store the ACK packet number as the last ACK'd packet
-        If a timeout occurs, enter packet loss recovery mode
+        An ACK means every packet up to it has arrived, so those packets and their ACK timers are dropped
+            and the window grows by a packet
+        An ACK for packets already ACK'd means the receiver is missing the packet after them, so rewind right away
+            rather than waiting out the ACK timeout
         """
-        try:
-            raw_ack, addr = self.sender_socket.recvfrom(1024)
-            unpacked_ack = struct.unpack("!2I", raw_ack)
-
-            ack_connectionID, ack_packet_num = unpacked_ack
+        while True:
+            try:
+                raw_ack = self.sender_socket.recv(_ACK.size)    # the sender address isn't needed, only the 8 ACK bytes
+            except BlockingIOError:     # no more ACKs waiting
+                return
+            ack_connectionID, ack_packet_num = _ACK.unpack(raw_ack)
 
-            ic(ack_connectionID, ack_packet_num)
-            ic(self.ack_gap, self.last_acked_packet_num)
-            ic("---------------------------------")
+            if DEBUG:
+                ic(ack_connectionID, ack_packet_num)
+                ic(self.ack_gap, self.last_acked_packet_num)
+                ic("---------------------------------")
 
-            self.ack_gap += 1                           # increment ACK gap by 1 for each received ACK
             self.timeout_counter = 0                    # reset the consecutive timeout counter to indicate receiver is responding
-            self.last_acked_packet_num = ack_packet_num     # store the last ack'd packet
-            # self.read_packet()                        # read next packet from file
-        except timeout:
+            self.last_ack_at = time.monotonic()
+            if ack_packet_num < self.first_unacked:
+                if self.first_unacked > self.recovery_point:    # once per loss, not for every repeat of the ACK
+                    if DEBUG:
+                        ic("Repeated ACK, rewinding to packet", self.first_unacked)
+                    self.rewind()
+                continue
+
+            # increment ACK gap by 1 for each received ACK, a quarter window at most so the window keeps moving
+            self.ack_gap = min(self.ack_gap + 1, self.window // 4)
+            self.last_acked_packet_num = max(self.last_acked_packet_num, ack_packet_num)   # store the last ack'd packet
+
+            # time the round trip, except to a retransmitted packet: its ACK could be for either send
+            sent_at = self.outstanding.get(ack_packet_num)
+            if sent_at is not None and ack_packet_num > self.recovery_point:
+                rtt = self.last_ack_at - sent_at
+                self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
+                self.ack_timeout = min(ACK_TIMEOUT, max(MIN_ACK_TIMEOUT, 4 * self.rtt))
+
+            # everything up to the ACK'd packet has arrived, it never needs retransmitting
+            self.window_acked += ack_packet_num + 1 - self.first_unacked
+            self.first_unacked = ack_packet_num + 1
+            if self.window_acked >= self.window:    # grow back a packet per window's worth ACK'd, probing for more room
+                self.window_acked -= self.window
+                self.window = min(self.max_window, self.window + 1)
+            self.outstanding = {packet_num: sent_at for packet_num, sent_at in self.outstanding.items()
+                                if packet_num > ack_packet_num}
+
+    def time_until_timeout(self):
+        """ Seconds until the oldest outstanding ACK is due, the wait doubles with every consecutive timeout """
+        timeout = min(ACK_TIMEOUT, self.ack_timeout * 2 ** self.timeout_counter)
+        if not self.outstanding:
+            return timeout
+        oldest = next(iter(self.outstanding.values()))
+        return max(0, oldest + timeout - time.monotonic())
+
+    def check_timeouts(self):
+        """ Enter packet loss recovery mode if the oldest outstanding ACK is overdue """
+        if self.outstanding and self.time_until_timeout() == 0:
             self.packet_loss_recovery()
 
     def packet_loss_recovery(self):
         """
         Upon encountering a timeout while waiting for an ACK, enter packet loss recovery mode
-        Use timeout counter to determine if the receiver is still responding
-        Reset the gap between ACK'd packets to 0, reset the packet number to the first unACK'd packet
-        Move file pointer back to start of last unACK'd packet
+        Use the time since the last ACK to determine if the receiver is still responding, then rewind
         """
-        print("PacketLossDetected: Packet loss detected, beginning retransmission with packet", self.last_acked_packet_num)
-
         # check to see how many consecutive timeouts
         self.timeout_counter += 1
 
-        if self.timeout_counter == 5:
+        if time.monotonic() - self.last_ack_at >= RECEIVER_TIMEOUT:
             raise ReceiverNotResponding
 
-        # start re-transmitting packets, starting with the one after the last ack'd packet
-        self.ack_gap = 0     # reset ack-gap to 0
-        self.packet_index = self.last_acked_packet_num    # reset packet number to beginning of retransmitted packets
-            
-        # reset file pointer to end of last ACK'd packet
-        self.file.seek(self.last_acked_packet_num * PACKET_SIZE)
-        #self.read_packet()  # start reading packets again
+        self.rewind()
+
+    def rewind(self):
+        """
+        Go back to the first unACK'd packet, so send_window retransmits every packet from there
+        Halve the window, so the retransmitted packets don't overrun the receiver's buffer the way the lost ones did
+        Reset the gap between ACK'd packets to 0, so every retransmitted packet is flagged until ACKs come back
+        """
+        print("PacketLossDetected: Packet loss detected, beginning retransmission with packet", self.first_unacked)
+
+        self.recovery_point = self.packet_index - 1
+        self.packet_index = self.first_unacked
+        self.window = max(1, self.window // 2)
+        self.window_acked = 0
+        self.ack_gap = 0
+        self.last_flagged_packet_num = self.first_unacked
+        self.outstanding = {}
 
 
 # Take in command line arguments